@@ -1,61 +1,168 @@
 import streamlit as st
-import requests
+import httpx
 import json
+import time
+from dataclasses import dataclass
 
 # --- Configuration & Constants ---
-API_BASE_URL_TEMPLATE = "https://bot.insightstream.ru/agent/{assistant_id}/v1/chat/completions"
+API_BASE_URL = "https://bot.insightstream.ru/agent"
+MAX_HISTORY_TURNS = 20 # Sliding window: only the last N messages are sent to the API
+MAX_RENDERED_MESSAGES = 20 # Older messages collapse into an "Earlier messages" expander
+RESPONSE_CACHE_SIZE = 32 # Exact-match (assistant, history) -> response cache entries kept
+_MD_CHARS = frozenset("*_`[#>|\\~") # If none of these appear, skip the markdown parser
+
+# Streamlit re-execs the script in a fresh namespace on every rerun, so the
+# client must live behind cache_resource to keep its connection pool (and
+# warm TLS sessions) alive between turns and shared across sessions.
+# httpx.Client is thread-safe, and each Streamlit session runs on its own
+# thread, so concurrent sessions just draw from the same pool.
+@st.cache_resource
+def _get_client() -> httpx.Client:
+    return httpx.Client(
+        headers={"Accept-Encoding": "gzip, br"},
+        timeout=httpx.Timeout(120.0, connect=5.0),
+        transport=httpx.HTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_keepalive_connections=10),
+        ),
+    )
+
+# --- Helper Functions ---
+def format_sources_md(sources: list) -> str:
+    """Renders a source list to one markdown string (numbered links)."""
+    return "\n".join(
+        f"{i+1}. [{s.get('source_document_name', 'Unknown Document')}]({s.get('source_location', '#')})"
+        for i, s in enumerate(sources)
+    )
+
 
 # --- Helper Function to Call API ---
-def get_assistant_response(api_token: str, assistant_id: str, messages_history: list):
+def get_assistant_response(api_token: str, assistant_id: str, messages_history: list, placeholder=None):
     """
-    Calls the RAG LLM bot API.
+    Calls the RAG LLM bot API and streams the reply.
+
+    Delta events are rendered incrementally into `placeholder` (an
+    `st.empty()` slot) as they arrive, so the user sees tokens instead of
+    waiting for the full generation.
     """
     if not api_token or not assistant_id:
         return None, None, "API Token or Assistant ID is missing."
 
-    url = API_BASE_URL_TEMPLATE.format(assistant_id=assistant_id)
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_token}"
-    }
+    # assistant_id rarely changes within a session, so memoize the built URL.
+    url_cache = st.session_state.setdefault("_url_cache", {})
+    url = url_cache.get(assistant_id)
+    if url is None:
+        url = f"{API_BASE_URL}/{assistant_id}/v1/chat/completions"
+        url_cache[assistant_id] = url
+    # The token is stable for a session, so build the auth header once and
+    # reuse it until the token changes. Kept in session_state (not on the
+    # shared client) so tokens never leak between user sessions.
+    cached = st.session_state.get("_hdr_cache")
+    if cached is None or cached[0] != api_token:
+        cached = (api_token, {"Authorization": f"Bearer {api_token}"})
+        st.session_state._hdr_cache = cached
+    headers = cached[1]
+    # Cap the history sent per request so payload size and server-side
+    # prompt processing stay bounded as the conversation grows. A leading
+    # system message (if any) is always kept.
+    trimmed = messages_history[-MAX_HISTORY_TURNS:]
+    if messages_history and messages_history[0]["role"] == "system" and len(messages_history) > MAX_HISTORY_TURNS:
+        trimmed = [messages_history[0]] + trimmed
+
     # The API expects a list of messages with "role" and "content"
     # We need to ensure our stored messages (which might include 'sources')
     # are formatted correctly for the API.
-    api_payload_messages = []
-    for msg in messages_history:
-        api_payload_messages.append({"role": msg["role"], "content": msg["content"]})
+    api_payload_messages = [{"role": m["role"], "content": m["content"]} for m in trimmed]
 
     payload = {
         "messages": api_payload_messages,
-        "stream": False # As per your example
+        "stream": True # Consume the reply as SSE delta events
     }
 
+    # Exact-repeat prompts ("say that again", copy-pasted queries) skip the
+    # network entirely: cache responses keyed by assistant + sent history.
+    cache_key = (assistant_id, tuple((m["role"], m["content"]) for m in trimmed))
+    resp_cache = st.session_state.setdefault("_resp_cache", {})
+    cached_resp = resp_cache.get(cache_key)
+    if cached_resp is not None:
+        cached_content, cached_sources = cached_resp
+        if placeholder is not None:
+            placeholder.markdown(cached_content)
+        return cached_content, cached_sources, None
+
+    buf = []
+    sources = None
+    # Publish gate: flush to the placeholder only when both thresholds are
+    # met, so long replies don't trigger a Streamlit re-render per token.
+    last_flush = time.monotonic()
+    pending_chars = 0
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(payload), timeout=120) # Added timeout
-        response.raise_for_status() # Will raise an HTTPError for bad responses (4XX or 5XX)
-        
-        data = response.json()
-        
-        assistant_content = data.get("choices", [{}])[0].get("message", {}).get("content")
-        sources = data.get("sources")
-        
+        with _get_client().stream("POST", url, headers=headers, json=payload) as response:
+            if response.is_error:
+                # Read the body while the stream is still open so the
+                # error handler below can show it; after the with-block
+                # closes, reading raises StreamClosed.
+                response.read()
+            response.raise_for_status() # Will raise an HTTPStatusError for bad responses (4XX or 5XX)
+
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                if line.startswith("data: "):
+                    line = line[len("data: "):]
+                if line == "[DONE]":
+                    break
+                event = json.loads(line)
+                # Some APIs attach the source list to one of the stream events.
+                if event.get("sources"):
+                    sources = event["sources"]
+                # Direct key walk: no throwaway [{}]/{} allocations per
+                # event, and try-entry is free on the (common) success path.
+                try:
+                    delta = event["choices"][0]["delta"].get("content")
+                except (KeyError, IndexError, TypeError):
+                    continue # Event without a delta (e.g. role or usage frame)
+                if delta:
+                    buf.append(delta)
+                    pending_chars += len(delta)
+                    now = time.monotonic()
+                    if placeholder is not None and now - last_flush >= 0.05 and pending_chars >= 8:
+                        # Plain text during the stream is the fast path; the
+                        # final flush below does the one markdown render.
+                        placeholder.text("".join(buf))
+                        last_flush = now
+                        pending_chars = 0
+
+        assistant_content = "".join(buf)
+
         if not assistant_content:
             return None, None, "Received an empty response from the assistant."
-            
+
+        if placeholder is not None:
+            placeholder.markdown(assistant_content)
+
+        if len(resp_cache) >= RESPONSE_CACHE_SIZE:
+            resp_cache.pop(next(iter(resp_cache))) # FIFO eviction (dicts keep insertion order)
+        resp_cache[cache_key] = (assistant_content, sources)
         return assistant_content, sources, None
 
-    except requests.exceptions.HTTPError as http_err:
-        error_detail = f"HTTP error occurred: {http_err}. Response: {response.text}"
+    except httpx.HTTPStatusError as http_err:
+        # Body was read above while the stream was open. Cap and decode it
+        # once — error pages can be multi-megabyte HTML and don't belong in
+        # the UI or the chat history unbounded.
+        err_body = http_err.response.content[:2048].decode("utf-8", errors="replace")
+        error_detail = f"HTTP error occurred: {http_err}. Response: {err_body}"
         st.error(f"API Error: {error_detail}") # Show detailed error in UI
         return None, None, error_detail
-    except requests.exceptions.RequestException as req_err:
+    except httpx.RequestError as req_err:
         st.error(f"Request error occurred: {req_err}")
         return None, None, f"Request error: {req_err}"
     except json.JSONDecodeError:
-        st.error(f"Failed to decode JSON response: {response.text}")
-        return None, None, f"JSON decode error. Response: {response.text}"
+        st.error(f"Failed to decode a streamed event: {line}")
+        return None, None, f"JSON decode error. Event: {line}"
     except (IndexError, KeyError) as e:
-        st.error(f"Unexpected API response structure: {e}. Response: {data if 'data' in locals() else 'N/A'}")
+        st.error(f"Unexpected API response structure: {e}")
         return None, None, f"Unexpected API response structure: {e}"
 
 
@@ -63,123 +170,165 @@ def get_assistant_response(api_token: str, assistant_id: str, messages_history:
 st.set_page_config(page_title="RAG LLM Chat", layout="wide", initial_sidebar_state="expanded")
 st.title("💬 Minimalistic RAG LLM Chatbot")
 
+# Session configuration lives in one dataclass under a single session_state
+# key: one SessionState lookup per rerun instead of one per field, and the
+# field reads are plain attribute access.
+@dataclass
+class Cfg:
+    api_token: str = ""
+    assistant_id: str = ""
+    config_error: str = ""
+
+
 # Initialize session state variables
 if "messages" not in st.session_state:
     st.session_state.messages = [] # Stores chat history: [{"role": "user/assistant", "content": "...", "sources": [...]}]
-if "api_token" not in st.session_state:
-    st.session_state.api_token = ""
-if "assistant_id" not in st.session_state:
-    st.session_state.assistant_id = ""
-if "config_error" not in st.session_state:
-    st.session_state.config_error = ""
+st.session_state.setdefault("cfg", Cfg())
+cfg = st.session_state.cfg
 
 
 # --- Sidebar for Configuration ---
+def _sync_config():
+    config = st.session_state.cfg
+    config.api_token = st.session_state.api_token_input
+    config.assistant_id = st.session_state.assistant_id_input
+    config.config_error = "" # Clear error if user is typing
+
+
+def _reset_all():
+    st.session_state.messages = []
+    st.session_state.cfg = Cfg()
+    st.session_state.api_token_input = ""
+    st.session_state.assistant_id_input = ""
+
+
 with st.sidebar:
     st.header("⚙️ Configuration")
-    
-    # Use previously entered values from session_state or empty strings
-    api_token_input = st.text_input(
-        "API Token", 
-        value=st.session_state.api_token, 
+
+    # The widgets own their own session_state entries via key=; on_change
+    # mirrors them into the cfg dataclass, the single source the rest of
+    # the script reads from.
+    st.text_input(
+        "API Token",
         type="password",
-        key="api_token_input_key" # Unique key for input widget
+        key="api_token_input",
+        on_change=_sync_config
     )
-    assistant_id_input = st.text_input(
-        "Assistant Name", 
-        value=st.session_state.assistant_id,
-        key="assistant_id_input_key" # Unique key for input widget
+    st.text_input(
+        "Assistant Name",
+        key="assistant_id_input",
+        on_change=_sync_config
     )
 
-    # Update session state when inputs change
-    if api_token_input != st.session_state.api_token:
-        st.session_state.api_token = api_token_input
-        st.session_state.config_error = "" # Clear error if user is typing
-        
-    if assistant_id_input != st.session_state.assistant_id:
-        st.session_state.assistant_id = assistant_id_input
-        st.session_state.config_error = "" # Clear error if user is typing
-
-    if st.button("🔄 Refresh All & Clear Chat", use_container_width=True):
-        st.session_state.messages = []
-        st.session_state.api_token = ""
-        st.session_state.assistant_id = ""
-        st.session_state.config_error = ""
-        # To make text_input fields update, we need to clear their specific keys or rerun
-        st.session_state.api_token_input_key = "" 
-        st.session_state.assistant_id_input_key = ""
-        st.rerun()
-
-    if st.session_state.config_error:
-        st.error(st.session_state.config_error)
+    st.button("🔄 Refresh All & Clear Chat", use_container_width=True, on_click=_reset_all)
+
+    if cfg.config_error:
+        st.error(cfg.config_error)
 
     st.markdown("---")
     st.markdown("Enter your API token and the specific assistant name you want to chat with.")
     st.markdown("The chat history will be cleared if you refresh.")
 
 # --- Display Chat Messages ---
-for message in st.session_state.messages:
+def render_chat_message(message: dict, in_expander: bool = False):
     with st.chat_message(message["role"]):
-        st.markdown(message["content"])
-        if "sources" in message and message["sources"]:
-            with st.expander("📚 Sources", expanded=False):
-                for i, source in enumerate(message["sources"]):
-                    doc_name = source.get("source_document_name", "Unknown Document")
-                    doc_loc = source.get("source_location", "#")
-                    st.markdown(f"{i+1}. [{doc_name}]({doc_loc})")
+        if message.get("_is_plain"):
+            # Flagged at append time: no markdown syntax, so st.text skips
+            # the whole parse/sanitize pass on every rerun.
+            st.text(message["content"])
+        else:
+            st.markdown(message["content"])
+        sources_md = message.get("sources_md")
+        if sources_md is None and message.get("sources"):
+            # Back-fill the cache for entries that carry a raw source list
+            # but were never pre-rendered — pay the formatting cost once,
+            # on first draw, never again.
+            sources_md = message["sources_md"] = format_sources_md(message["sources"])
+        if sources_md:
+            if in_expander:
+                # Expanders can't nest (Streamlit < 1.46), so messages
+                # already inside "Earlier messages" show their cached
+                # sources inline under the content.
+                st.markdown("📚 Sources:\n" + sources_md)
+            else:
+                # pop() auto-clears the freshness flag after its first render.
+                with st.expander("📚 Sources", expanded=message.pop("_fresh", False)):
+                    # One markdown call per rerun instead of one per source.
+                    st.markdown(sources_md)
+
+
+# Only the last MAX_RENDERED_MESSAGES get a full chat bubble; older ones
+# sit in a collapsed expander so long chats stay cheap to redraw. As a
+# fragment, the whole loop is skipped when only sidebar widgets change.
+@st.fragment
+def render_chat_history():
+    old_messages = st.session_state.messages[:-MAX_RENDERED_MESSAGES]
+    recent_messages = st.session_state.messages[-MAX_RENDERED_MESSAGES:]
+    if old_messages:
+        with st.expander(f"Earlier messages ({len(old_messages)})", expanded=False):
+            for message in old_messages:
+                render_chat_message(message, in_expander=True)
+    for message in recent_messages:
+        render_chat_message(message)
+
+
+render_chat_history()
 
 # --- Chat Input Field ---
 if prompt := st.chat_input("Ask your question..."):
     # Check for API token and assistant ID before proceeding
-    if not st.session_state.api_token or not st.session_state.assistant_id:
-        st.session_state.config_error = "⚠️ Please enter your API Token and Assistant Name in the sidebar first!"
+    if not cfg.api_token or not cfg.assistant_id:
+        cfg.config_error = "⚠️ Please enter your API Token and Assistant Name in the sidebar first!"
         st.rerun() # Rerun to display the error message immediately
     else:
-        st.session_state.config_error = "" # Clear any previous config error
+        cfg.config_error = "" # Clear any previous config error
 
-        # Add user message to chat history and display it
+        # Add user message to chat history. It is NOT rendered inline:
+        # the explicit rerun below draws the whole new turn in one pass.
         st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
-            st.markdown(prompt)
 
-        # Get assistant's response
+        # Get assistant's response, streamed into a single placeholder so
+        # Streamlit only patches one DOM node per update. This in-progress
+        # bubble is the only inline work during the API wait.
         with st.chat_message("assistant"):
-            with st.spinner("🧠 Thinking..."):
-                assistant_content, sources, error_message = get_assistant_response(
-                    st.session_state.api_token,
-                    st.session_state.assistant_id,
-                    st.session_state.messages # Send the whole history
-                )
-            
+            placeholder = st.empty()
+            placeholder.markdown("🧠 Thinking...")
+            assistant_content, sources, error_message = get_assistant_response(
+                cfg.api_token,
+                cfg.assistant_id,
+                st.session_state.messages, # Send the whole history
+                placeholder=placeholder
+            )
+
             if error_message:
-                st.error(f"Assistant Error: {error_message}")
-                # Optionally remove the last user message if the API call failed catastrophically
-                # or add an error message from assistant. For now, just show error.
-                # To prevent a broken state, let's add an error message to the chat
+                # Store the error as an assistant message so the state
+                # isn't broken; the redraw renders it like any other turn.
                 error_chat_entry = {"role": "assistant", "content": f"Sorry, I encountered an error: {error_message}"}
                 st.session_state.messages.append(error_chat_entry)
-                st.markdown(error_chat_entry["content"])
-
             elif assistant_content:
-                st.markdown(assistant_content)
-                assistant_chat_entry = {"role": "assistant", "content": assistant_content}
+                # Already rendered incrementally into the placeholder.
+                # isdisjoint is a single C-level scan over the content.
+                assistant_chat_entry = {
+                    "role": "assistant",
+                    "content": assistant_content,
+                    "_is_plain": _MD_CHARS.isdisjoint(assistant_content),
+                }
                 if sources:
                     assistant_chat_entry["sources"] = sources
-                    with st.expander("📚 Sources", expanded=True): # Expand for new sources by default
-                        for i, source in enumerate(sources):
-                            doc_name = source.get("source_document_name", "Unknown Document")
-                            doc_loc = source.get("source_location", "#")
-                            st.markdown(f"{i+1}. [{doc_name}]({doc_loc})")
+                    assistant_chat_entry["sources_md"] = format_sources_md(sources)
+                    assistant_chat_entry["_fresh"] = True # Expand sources on the first redraw only
                 st.session_state.messages.append(assistant_chat_entry)
             else:
                 # This case should ideally be caught by error_message in get_assistant_response
-                st.error("Received no content from assistant.")
                 fallback_message = "Sorry, I couldn't generate a response."
                 st.session_state.messages.append({"role": "assistant", "content": fallback_message})
-                st.markdown(fallback_message)
+
+            # Single redraw for the whole turn: the history loop renders
+            # the new user and assistant messages once, from stored state.
+            st.rerun()
 
 # Add a small welcome message if chat is empty and config is set
-if not st.session_state.messages and st.session_state.api_token and st.session_state.assistant_id:
-    st.info(f"Ready to chat with '{st.session_state.assistant_id}'! Type your first message below.")
-elif not st.session_state.messages and (not st.session_state.api_token or not st.session_state.assistant_id):
+if not st.session_state.messages and cfg.api_token and cfg.assistant_id:
+    st.info(f"Ready to chat with '{cfg.assistant_id}'! Type your first message below.")
+elif not st.session_state.messages and (not cfg.api_token or not cfg.assistant_id):
      st.info("Please configure your API Token and Assistant Name in the sidebar to begin.")